@@ -0,0 +1,29 @@
+"""Konversi satu kali model TF.js ke artefak SavedModel native.
+
+Dijalankan di mesin build, bukan di container serving — tensorflowjs tidak
+lagi menjadi dependensi runtime. Hasil konversi diunggah ke GCS (dan
+MODEL_URL diarahkan ke sana) atau dibundel ke image di PREBAKED_MODEL_PATH:
+
+    pip install tensorflowjs
+    python convert.py model.json model_savedmodel
+    gsutil cp -r model_savedmodel gs://penyimpanan123/model_savedmodel
+"""
+
+import sys
+
+import tensorflowjs as tfjs
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Pemakaian: python convert.py <model.json> <output_dir>")
+        sys.exit(1)
+
+    _, model_json, output_dir = sys.argv
+    model = tfjs.converters.load_keras_model(model_json)
+    model.save(output_dir, save_format="tf")
+    print(f"Model tersimpan di {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Konfigurasi Gunicorn untuk serving di Cloud Run."""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+timeout = 60
+# Muat model sekali di master lalu fork worker; memori model dibagi lewat
+# copy-on-write, bukan satu salinan penuh per worker
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Thread daemon, warmup, dan channel gRPC tidak selamat dari fork();
+    # inisialisasi ulang di tiap proses worker
+    import main
+    main.initialize_worker()
@@ -1,14 +1,30 @@
+import io
 import os
 import uuid
-import json
+import secrets
+import time
+import atexit
+import queue
+import shutil
+import hashlib
+import functools
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
+# Harus diset sebelum tensorflow di-import agar kernel oneDNN (AVX-512/VNNI) aktif
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "1")
+
+import numpy as np
+import orjson
 import tensorflow as tf
-import tensorflowjs as tfjs
+from PIL import Image
 import requests
 
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from google.cloud import storage, firestore
 from google.oauth2 import service_account
 from google.cloud.firestore import SERVER_TIMESTAMP
@@ -23,42 +39,290 @@ logging.basicConfig(
     ]
 )
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Provider JSON Flask berbasis orjson (serialisasi C, jauh lebih cepat)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Inisialisasi aplikasi Flask
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Konfigurasi dari environment variables
 MODEL_URL = os.environ.get("MODEL_URL")
 LOCAL_MODEL_PATH = "/penyimpanan123/model.json"
+# Model yang sudah dibundel di image (COPY saat build) — tanpa unduhan cold start
+PREBAKED_MODEL_PATH = os.environ.get("PREBAKED_MODEL_PATH", "/opt/model")
+# Cache flatbuffer TFLite hasil konversi startup
+TFLITE_CACHE_PATH = os.environ.get("TFLITE_CACHE_PATH", "/tmp/model.tflite")
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
 GCS_BUCKET_NAME = 'penyimpanan123'
 
 # Global variabel
 db = None
 model = None
+infer_fn = None
+interpreter = None
+interpreter_lock = threading.Lock()
 storage_client = None
+gcs_bucket = None
+
+def intraop_thread_count():
+    """Jumlah thread compute per proses, mengikuti kuota CPU per worker"""
+    return int(os.environ.get("TF_NUM_INTRAOP_THREADS", os.cpu_count() or 1))
+
+def gcs_public_url(gcs_path):
+    """Susun URL publik objek GCS tanpa menyentuh metadata/ACL blob"""
+    return f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{gcs_path}"
+
+def get_bucket():
+    """Ambil handle bucket GCS yang dibuat sekali dan dipakai ulang"""
+    global gcs_bucket
+    if gcs_bucket is None:
+        gcs_bucket = storage_client.bucket(GCS_BUCKET_NAME)
+    return gcs_bucket
+
+# Cache string timestamp per detik; hanya komponen mikrodetik yang diformat
+# ulang per request
+timestamp_cache = (0, "")
+
+def now_iso():
+    """Timestamp ISO-8601 tanpa membangun objek datetime per panggilan"""
+    global timestamp_cache
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = timestamp_cache
+    if second != cached_second:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(second))
+        timestamp_cache = (second, prefix)
+    return f"{prefix}.{int((now - second) * 1e6):06d}"
+
+# Label kelas dan teks penjelasan/saran, dibangun sekali di level modul
+CLASSES = ("Melanocytic nevus", "Squamous cell carcinoma", "Vascular lesion")
+
+EXPLANATIONS = {
+    "Melanocytic nevus": "Kondisi permukaan kulit dengan bercak warna dari sel melanosit.",
+    "Squamous cell carcinoma": "Kanker kulit yang sering muncul di area terkena sinar UV.",
+    "Vascular lesion": "Tumor atau kanker yang sering muncul di kepala dan leher."
+}
+
+SUGGESTIONS = {
+    "Melanocytic nevus": "Konsultasi dokter jika ada perubahan ukuran atau warna.",
+    "Squamous cell carcinoma": "Segera konsultasi untuk mencegah penyebaran.",
+    "Vascular lesion": "Konsultasikan untuk tindakan lebih lanjut."
+}
+
+# Micro-batching: request yang tiba dalam jendela singkat digabung jadi satu
+# forward pass supaya overhead per-panggilan teramortisasi
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "16"))
+BATCH_TIMEOUT_S = float(os.environ.get("BATCH_TIMEOUT_MS", "10")) / 1000.0
+batch_queue = queue.Queue()
+batch_worker_thread = None
+
+# Pool untuk pekerjaan I/O di background; respons HTTP tidak perlu menunggu
+# round-trip GCS/Firestore
+write_pool = ThreadPoolExecutor(max_workers=8)
+
+# Antrean penulisan Firestore; worker menggabungkan dokumen yang datang
+# berdekatan menjadi satu commit WriteBatch (sweet spot ~40 operasi)
+FIRESTORE_BATCH_SIZE = 40
+firestore_queue = queue.Queue()
+firestore_worker_thread = None
+
+# Cache hasil prediksi per konten gambar, supaya upload berulang (retry/demo)
+# tidak menjalankan ulang forward pass CNN
+PREDICTION_CACHE_SIZE = int(os.environ.get("CACHE_SIZE", "1024"))
+prediction_cache = OrderedDict()
+prediction_cache_lock = threading.Lock()
+
+# Buffer input per-thread yang dipakai ulang antar request; aman karena setiap
+# thread handler menunggu hasil inferensinya sebelum memakai buffer lagi
+thread_buffers = threading.local()
+
+def get_input_buffer():
+    """Ambil buffer input (1,224,224,3) uint8 milik thread ini, alokasi sekali saja"""
+    buffer = getattr(thread_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = np.empty((1, 224, 224, 3), dtype=np.uint8)
+        thread_buffers.buffer = buffer
+    return buffer
+
+def preprocess_image(image_bytes):
+    """Decode + resize gambar via Pillow (libjpeg-turbo); normalisasi jalan di graph"""
+    image = Image.open(io.BytesIO(image_bytes))
+    # Untuk JPEG, draft() men-decode langsung di resolusi mendekati target
+    # (DCT scaling) sehingga resize penuh tidak perlu dilakukan dari ukuran asli
+    image.draft("RGB", (224, 224))
+    image = image.convert("RGB").resize((224, 224), Image.BILINEAR)
+    buffer = get_input_buffer()
+    buffer[0] = np.asarray(image, dtype=np.uint8)
+    return buffer
+
+def run_model(batch):
+    """Jalankan forward pass untuk satu batch input yang sudah dipreproses"""
+    if interpreter is not None:
+        input_details = interpreter.get_input_details()[0]
+        output_details = interpreter.get_output_details()[0]
+
+        with interpreter_lock:
+            if interpreter.get_input_details()[0]['shape'][0] != batch.shape[0]:
+                interpreter.resize_tensor_input(input_details['index'], list(batch.shape))
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_details['index'], batch)
+            interpreter.invoke()
+            probs = interpreter.get_tensor(output_details['index'])
+
+        scale, zero_point = output_details['quantization']
+        if scale:
+            probs = (probs.astype(np.float32) - zero_point) * scale
+        return probs
+
+    return infer_fn(batch).numpy()
+
+def batch_worker():
+    """Kumpulkan request yang datang berdekatan lalu jalankan satu forward pass batch"""
+    while True:
+        items = [batch_queue.get()]
+        deadline = time.monotonic() + BATCH_TIMEOUT_S
+        while len(items) < BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            batch = np.concatenate([input_array for input_array, _ in items], axis=0)
+            probs = run_model(batch)
+            for (_, future), row in zip(items, probs):
+                future.set_result(row)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+
+def submit_inference(input_array):
+    """Kirim satu input ke micro-batcher dan tunggu hasilnya"""
+    # Thread yang diwarisi dari fork() sudah mati; jangan antre ke antrean
+    # yang tidak pernah di-drain
+    if batch_worker_thread is None or not batch_worker_thread.is_alive():
+        return run_model(input_array)[0]
+
+    future = Future()
+    batch_queue.put((input_array, future))
+    return future.result()
+
+def representative_dataset_gen():
+    """Hasilkan sampel kalibrasi dari gambar di REPRESENTATIVE_SAMPLES_DIR"""
+    samples_dir = os.environ.get("REPRESENTATIVE_SAMPLES_DIR", "/app/samples")
+    for name in sorted(os.listdir(samples_dir))[:100]:
+        with open(os.path.join(samples_dir, name), "rb") as f:
+            yield [preprocess_image(f.read())]
+
+def build_serving_model(model):
+    """Bungkus model dengan layer Rescaling agar cast + normalisasi jalan di dalam graph
+
+    Dengan begitu kode Python cukup mengirim piksel uint8 mentah; runtime
+    menjalankan cast/255 sebagai bagian dari graph yang sudah difusi.
+    """
+    inputs = tf.keras.Input(shape=(224, 224, 3), dtype=tf.uint8)
+    outputs = model(tf.keras.layers.Rescaling(1.0 / 255.0)(inputs))
+    return tf.keras.Model(inputs, outputs)
+
+def build_infer_fn(serving_model):
+    """Bangun fungsi forward pass yang sudah di-trace sekali"""
+    @tf.function(input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.uint8)])
+    def infer(input_tensor):
+        return serving_model(input_tensor, training=False)
+
+    return infer
+
+def build_tflite_interpreter(serving_model):
+    """Konversi model Keras ke TFLite untuk inferensi CPU single-image yang lebih cepat"""
+    try:
+        # Flatbuffer hasil konversi di-cache di disk; restart instance warm
+        # langsung memuat tanpa konversi ulang
+        if os.path.exists(TFLITE_CACHE_PATH) and os.path.getsize(TFLITE_CACHE_PATH) > 0:
+            interp = tf.lite.Interpreter(
+                model_path=TFLITE_CACHE_PATH, num_threads=intraop_thread_count()
+            )
+            interp.allocate_tensors()
+            logging.info(f"Model TFLite dimuat dari cache {TFLITE_CACHE_PATH}")
+            return interp
+
+        def convert(full_int8):
+            converter = tf.lite.TFLiteConverter.from_keras_model(serving_model)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if full_int8:
+                converter.representative_dataset = representative_dataset_gen
+                converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+                converter.inference_input_type = tf.uint8
+                converter.inference_output_type = tf.uint8
+            return converter.convert()
+
+        # Kuantisasi INT8 penuh kalau tersedia gambar kalibrasi di container;
+        # kalau gagal (tidak semua op punya kernel INT8), mundur ke konversi
+        # dynamic-range alih-alih kehilangan TFLite sama sekali
+        samples_dir = os.environ.get("REPRESENTATIVE_SAMPLES_DIR", "/app/samples")
+        if os.path.isdir(samples_dir) and os.listdir(samples_dir):
+            try:
+                tflite_model = convert(full_int8=True)
+                logging.info("Kuantisasi INT8 penuh diaktifkan")
+            except Exception as e:
+                logging.warning(f"Konversi INT8 penuh gagal, pakai dynamic-range: {e}")
+                tflite_model = convert(full_int8=False)
+        else:
+            tflite_model = convert(full_int8=False)
 
+        try:
+            with open(TFLITE_CACHE_PATH, "wb") as f:
+                f.write(tflite_model)
+        except OSError as e:
+            logging.warning(f"Gagal menulis cache TFLite: {e}")
+
+        interp = tf.lite.Interpreter(
+            model_content=tflite_model, num_threads=intraop_thread_count()
+        )
+        interp.allocate_tensors()
+        logging.info("Model berhasil dikonversi ke TFLite")
+        return interp
+    except Exception as e:
+        logging.error(f"Gagal konversi ke TFLite, memakai model Keras: {e}")
+        return None
+
+@functools.lru_cache(maxsize=1)
 def get_credentials_from_env_var():
-    """Mengambil kredensial dari variabel lingkungan"""
+    """Mengambil kredensial dari variabel lingkungan (diparse sekali per proses)"""
     try:
         credentials_json = os.getenv("submission")
         if not credentials_json:
             logging.error("GCP_CREDENTIALS environment variable not set or empty")
             return None
         
-        credentials_info = json.loads(credentials_json)
+        credentials_info = orjson.loads(credentials_json)
         return service_account.Credentials.from_service_account_info(credentials_info)
     except Exception as e:
         logging.error(f"Error fetching credentials: {e}")
         return None
 
 def initialize_clients():
-    """Inisialisasi Google Cloud clients"""
-    global db, storage_client
+    """Inisialisasi Google Cloud clients untuk proses ini"""
+    global db, storage_client, gcs_bucket, firestore_worker_thread
     try:
         credentials = get_credentials_from_env_var()
         if credentials:
+            # Buat client baru (channel gRPC warisan fork() tidak bisa dipakai)
+            # dan buang handle bucket yang menempel ke client lama
             storage_client = storage.Client(credentials=credentials)
             db = firestore.Client(credentials=credentials)
+            gcs_bucket = None
+            firestore_worker_thread = threading.Thread(target=firestore_writer, daemon=True)
+            firestore_worker_thread.start()
             logging.info("Google Cloud clients berhasil diinisialisasi")
             return True
         # return False
@@ -69,66 +333,132 @@ def initialize_clients():
 def upload_to_gcs(local_path, gcs_path):
     """Unggah file ke Google Cloud Storage"""
     try:
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(gcs_path)
+        blob = get_bucket().blob(gcs_path)
         blob.upload_from_filename(local_path)
         logging.info(f"File {local_path} berhasil diunggah ke {gcs_path}")
-        return blob.public_url
+        return gcs_public_url(gcs_path)
+    except Exception as e:
+        logging.error(f"Error mengunggah ke GCS: {e}")
+        raise
+
+def upload_bytes_to_gcs(data, gcs_path, content_type="image/jpeg"):
+    """Unggah bytes dari memori langsung ke GCS tanpa file perantara"""
+    try:
+        blob = get_bucket().blob(gcs_path)
+        # Objek kecil dikirim sebagai satu request, tanpa buffer chunking 16 MiB
+        blob.chunk_size = None if len(data) < (8 << 20) else 8 << 20
+        blob.upload_from_string(data, content_type=content_type)
+        logging.info(f"{len(data)} bytes berhasil diunggah ke {gcs_path}")
+        return gcs_public_url(gcs_path)
     except Exception as e:
         logging.error(f"Error mengunggah ke GCS: {e}")
         raise
 
 def save_metadata_to_firestore(collection_name, document_id, data):
-    """Simpan metadata ke Firestore"""
+    """Antrekan metadata untuk ditulis ke Firestore lewat WriteBatch"""
     if db:
+        # Salin dulu: sentinel SERVER_TIMESTAMP tidak boleh bocor ke dict
+        # milik caller yang masih dipakai untuk respons JSON
+        firestore_queue.put(
+            (collection_name, document_id, {**data, 'uploaded_at': SERVER_TIMESTAMP})
+        )
+
+def commit_firestore_batch(items):
+    """Commit sekumpulan dokumen sebagai satu WriteBatch"""
+    try:
+        batch = db.batch()
+        for collection_name, document_id, data in items:
+            batch.set(db.collection(collection_name).document(document_id), data)
+        batch.commit()
+        logging.info(f"Batch {len(items)} dokumen berhasil disimpan ke Firestore")
+    except Exception as e:
+        logging.error(f"Error menyimpan batch ke Firestore: {e}")
+
+def firestore_writer():
+    """Worker yang menggabungkan antrean tulisan Firestore menjadi commit batch"""
+    while True:
+        items = [firestore_queue.get()]
+        while len(items) < FIRESTORE_BATCH_SIZE:
+            try:
+                items.append(firestore_queue.get_nowait())
+            except queue.Empty:
+                break
+        commit_firestore_batch(items)
+
+def drain_firestore_queue():
+    """Tulis sisa antrean Firestore saat proses shutdown"""
+    items = []
+    while True:
         try:
-            data['uploaded_at'] = SERVER_TIMESTAMP
-            doc_ref = db.collection(collection_name).document(document_id)
-            doc_ref.set(data)
-            logging.info(f"Dokumen {document_id} berhasil disimpan ke Firestore")
-        except Exception as e:
-            logging.error(f"Error menyimpan ke Firestore: {e}")
-            raise
-
-def download_model(url, local_path):
-    """Unduh model dari URL"""
+            items.append(firestore_queue.get_nowait())
+        except queue.Empty:
+            break
+    if items and db:
+        commit_firestore_batch(items)
+
+# Urutan shutdown (LIFO): selesaikan submit background dulu, baru drain antrean
+atexit.register(drain_firestore_queue)
+atexit.register(write_pool.shutdown, wait=True)
+
+def backup_model(local_path, url):
+    """Unggah salinan model ke GCS dan catat metadatanya ke Firestore"""
     try:
-        logging.info(f"Mencoba mengunduh model dari: {url}")
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        
-        with open(local_path, "wb") as f:
-            f.write(response.content)
-        
-        # Upload model ke GCS setelah diunduh
+        # Bisa berjalan di master sebelum ada worker; siapkan clients sendiri
+        if storage_client is None and not initialize_clients():
+            logging.warning("Clients tidak tersedia, backup model dilewati")
+            return
+
         gcs_path = f"models/{os.path.basename(local_path)}"
         gcs_url = upload_to_gcs(local_path, gcs_path)
-        
-        # Simpan metadata model
+
         model_metadata = {
             "model_url": gcs_url,
             "original_url": url,
             "downloaded_at": datetime.now().isoformat()
         }
         save_metadata_to_firestore("models", str(uuid.uuid4()), model_metadata)
-        
-        logging.info("Model berhasil diunduh dan diunggah ke GCS")
+        logging.info("Backup model ke GCS selesai")
+    except Exception as e:
+        logging.error(f"Kesalahan backup model: {e}")
+
+def download_model(url, local_path):
+    """Unduh model dari URL"""
+    try:
+        # Pakai model yang sudah ada di disk (Cloud Run menggunakan ulang instance)
+        if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
+            logging.info(f"Model sudah ada di {local_path}, lewati unduhan")
+            return True
+
+        logging.info(f"Mencoba mengunduh model dari: {url}")
+
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+        }
+
+        # Streaming langsung ke disk supaya tidak menampung seluruh model di RAM
+        with requests.get(url, headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            with open(local_path, "wb") as f:
+                shutil.copyfileobj(response.raw, f, length=1 << 20)
+
+        # Backup ke GCS + metadata Firestore berjalan di background, tidak
+        # menahan cold start menunggu I/O yang tidak dibutuhkan untuk serving
+        threading.Thread(
+            target=backup_model, args=(local_path, url), daemon=True
+        ).start()
+
+        logging.info("Model berhasil diunduh")
         return True
     
     except Exception as e:
         logging.error(f"Kesalahan download model: {e}")
         return False
 
-def load_model(MODEL_URL):
-    """Muat model TensorFlow.js"""
+def load_model(model_path):
+    """Muat model Keras/SavedModel dari disk"""
     try:
-        logging.info("Memuat model TensorFlow.js")
-        model = tf.keras.model.load_model(MODEL_URL)
+        logging.info(f"Memuat model dari {model_path}")
+        model = tf.keras.models.load_model(model_path)
         logging.info("Model berhasil dimuat")
         return model
     except Exception as e:
@@ -137,32 +467,29 @@ def load_model(MODEL_URL):
 
 def predict_classification(model, image_bytes):
     """Lakukan klasifikasi gambar"""
-    try:
-        image = tf.image.decode_image(image_bytes, channels=3)
-        image = tf.image.resize(image, [224, 224])
-        input_tensor = tf.expand_dims(image, 0)
-        input_tensor = tf.cast(input_tensor, dtype=tf.float32) / 255.0
+    image_hash = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    with prediction_cache_lock:
+        if image_hash in prediction_cache:
+            prediction_cache.move_to_end(image_hash)
+            return prediction_cache[image_hash]
 
-        predictions = model.predict(input_tensor)
-        confidence_score = float(tf.reduce_max(predictions).numpy()) * 100
-        class_result = int(tf.argmax(predictions, axis=1).numpy()[0])
-
-        classes = ["Melanocytic nevus", "Squamous cell carcinoma", "Vascular lesion"]
-        label = classes[class_result]
+    try:
+        input_tensor = preprocess_image(image_bytes)
+        probs = submit_inference(input_tensor)
 
-        explanation = {
-            "Melanocytic nevus": "Kondisi permukaan kulit dengan bercak warna dari sel melanosit.",
-            "Squamous cell carcinoma": "Kanker kulit yang sering muncul di area terkena sinar UV.",
-            "Vascular lesion": "Tumor atau kanker yang sering muncul di kepala dan leher."
-        }.get(label, "Kondisi kulit tidak dikenali")
+        class_result = int(probs.argmax())
+        confidence_score = float(probs[class_result]) * 100
 
-        suggestion = {
-            "Melanocytic nevus": "Konsultasi dokter jika ada perubahan ukuran atau warna.",
-            "Squamous cell carcinoma": "Segera konsultasi untuk mencegah penyebaran.",
-            "Vascular lesion": "Konsultasikan untuk tindakan lebih lanjut."
-        }.get(label, "Disarankan pemeriksaan medis")
+        label = CLASSES[class_result]
+        explanation = EXPLANATIONS.get(label, "Kondisi kulit tidak dikenali")
+        suggestion = SUGGESTIONS.get(label, "Disarankan pemeriksaan medis")
 
-        return confidence_score, label, explanation, suggestion
+        result = (confidence_score, label, explanation, suggestion)
+        with prediction_cache_lock:
+            prediction_cache[image_hash] = result
+            if len(prediction_cache) > PREDICTION_CACHE_SIZE:
+                prediction_cache.popitem(last=False)
+        return result
 
     except Exception as e:
         logging.error(f"Kesalahan prediksi: {e}")
@@ -179,58 +506,103 @@ def predict_handler():
     if "image" not in request.files:
         return jsonify({"status": "gagal", "message": "Tidak ada gambar"}), 400
 
-    image = request.files["image"]
-    image_bytes = image.read()
+    # Baca stream upload sekali menjadi bytes dan oper ke seluruh pipeline
+    image_bytes = request.files["image"].stream.read()
 
     try:
-        confidence_score, label, suggestion = predict_classification(model, image_bytes)
+        confidence_score, label, explanation, suggestion = predict_classification(model, image_bytes)
 
-        # Upload gambar ke GCS
-        prediction_id = str(uuid.uuid4())
+        # Upload gambar ke GCS di background; respons tidak bergantung padanya
+        prediction_id = secrets.token_hex(16)
         gcs_path = f"predictions/{prediction_id}.jpg"
-        image_url = upload_to_gcs(image_bytes, gcs_path)
+        write_pool.submit(upload_bytes_to_gcs, image_bytes, gcs_path)
 
         data = {
             "id": prediction_id,
             "result": label,
             "suggestion": suggestion,
-            "createdAt": datetime.now().isoformat()
+            "createdAt": now_iso()
         }
 
-        # Simpan hasil prediksi ke Firestore
+        # Simpan hasil prediksi ke Firestore tanpa menahan respons
         save_metadata_to_firestore("predictions", prediction_id, data)
 
         pesan = "Prediksi berhasil" if confidence_score > 90 else "Prediksi diselesaikan dengan kepercayaan rendah"
-        return jsonify({
-            "data": data
-        }), 201
+        # Langsung orjson.dumps, tanpa mampir provider jsonify + decode ke str
+        return app.response_class(
+            orjson.dumps({"data": data}), status=201, mimetype="application/json"
+        )
 
     except Exception as e:
         logging.error(f"Kesalahan prediksi: {e}")
         return jsonify({"status": "error", "message": f"Kesalahan internal: {e}"}), 500
 
 def setup_application():
-    """Menyiapkan aplikasi dengan inisialisasi clients dan model"""
-    global model
-    
-    if not MODEL_URL:
+    """Menyiapkan model; aman dijalankan di master Gunicorn sebelum fork"""
+    global model, infer_fn, interpreter
+
+    # Batasi threadpool TF sesuai kuota CPU container supaya worker gunicorn
+    # tidak saling rebut core; harus dipanggil sebelum runtime TF aktif
+    try:
+        inter_threads = int(os.environ.get("TF_NUM_INTEROP_THREADS", 1))
+        tf.config.threading.set_intra_op_parallelism_threads(intraop_thread_count())
+        tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    except RuntimeError as e:
+        logging.warning(f"Runtime TF sudah aktif, konfigurasi threading dilewati: {e}")
+
+    if not MODEL_URL and not os.path.exists(PREBAKED_MODEL_PATH):
         logging.error("MODEL_URL tidak diset")
         return False
-    
-    # Inisialisasi Google Cloud clients
-    if not initialize_clients():
-        return False
-    
-    # Download dan muat model
-    if download_model(MODEL_URL, LOCAL_MODEL_PATH):
+
+    # Model bawaan image dipakai langsung; kalau tidak ada, unduh dari MODEL_URL
+    if os.path.exists(PREBAKED_MODEL_PATH):
+        model = load_model(PREBAKED_MODEL_PATH)
+    elif download_model(MODEL_URL, LOCAL_MODEL_PATH):
         model = load_model(LOCAL_MODEL_PATH)
-        return model is not None
-    
-    return False
+
+    if model is not None:
+        serving_model = build_serving_model(model)
+        infer_fn = build_infer_fn(serving_model)
+        interpreter = build_tflite_interpreter(serving_model)
+
+    return model is not None
+
+worker_ready = False
+worker_init_lock = threading.Lock()
+
+def initialize_worker():
+    """Inisialisasi state per-proses: clients, warmup, dan worker thread
+
+    Thread daemon dan channel gRPC tidak selamat dari fork(), jadi dengan
+    preload_app fungsi ini harus dipanggil ulang di tiap worker (hook
+    post_fork di gunicorn.conf.py), bukan sekali di master.
+    """
+    global worker_ready, batch_worker_thread
+
+    with worker_init_lock:
+        if worker_ready:
+            return
+
+        if not initialize_clients():
+            logging.critical("Gagal inisialisasi clients. Periksa konfigurasi.")
+
+        if model is not None:
+            # Warmup: tracing, alokasi tensor, dan autotune kernel terjadi
+            # sekali di startup worker, bukan di request pertama
+            dummy = np.zeros((1, 224, 224, 3), dtype=np.uint8)
+            for _ in range(3):
+                run_model(dummy)
+            logging.info("Warmup inferensi selesai")
+
+            batch_worker_thread = threading.Thread(target=batch_worker, daemon=True)
+            batch_worker_thread.start()
+
+        worker_ready = True
 
 # Jalankan setup saat aplikasi dimulai
 if not setup_application():
     logging.critical("Gagal menyiapkan aplikasi. Periksa konfigurasi.")
 
 if __name__ == "__main__":
+    initialize_worker()
     app.run(host="0.0.0.0", port=8080)
\ No newline at end of file